@@ -1,35 +1,129 @@
-from flask import Flask, request, send_file, jsonify
+from flask import Flask, Response, request, send_file, jsonify
 from flask_cors import CORS
+from flask_compress import Compress
+from pydantic import BaseModel, Field, ValidationError
 from docx import Document
 from docx.oxml.ns import qn
 from docx.shared import Pt, RGBColor, Inches
 from docx.enum.text import WD_ALIGN_PARAGRAPH
+from docx.table import _Cell
 from docx.oxml import parse_xml
 from docx.oxml.ns import nsdecls
+import copy
+import functools
+import hashlib
+import json
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import io
 import os
+import re
+import subprocess
+import xmlrpc.client
 import pypandoc
 import requests
-from PIL import Image
-import tempfile
-import lxml.etree as ET
+from requests.adapters import HTTPAdapter
+from pdf_server import UNOSERVER_PORT, pdf_server_available, start_pdf_server
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for frontend requests
+# Gzip JSON/text responses and PDFs; DOCX is already a deflated zip
+app.config['COMPRESS_MIMETYPES'] = [
+    'text/html', 'text/css', 'text/xml', 'application/json',
+    'application/javascript', 'application/pdf',
+]
+Compress(app)
 
 # Direct download URLs for stamp and signature
 PAID_STAMP_URL = "https://drive.google.com/uc?export=download&id=1W9PL0DtP0TUk7IcGiMD_ZuLddtQ8gjNo"
 SIGNATURE_URL = "https://drive.google.com/uc?export=download&id=1b6Dcg4spQmvLUMd4neBtLNfdr5l7QtPJ"
 
+# Invoice template on disk (loaded into TEMPLATE_BYTES below, after load_template)
+TEMPLATE_PATH = 'Invoice_Template_MarketixLab.docx'
+
+# Paragraph alignment of the description, unit price, quantity and total columns
+ITEM_ALIGNMENTS = (
+    WD_ALIGN_PARAGRAPH.LEFT, WD_ALIGN_PARAGRAPH.RIGHT,
+    WD_ALIGN_PARAGRAPH.CENTER, WD_ALIGN_PARAGRAPH.RIGHT,
+)
+
+# Clark-notation attribute names used on every styled run
+QN_EAST_ASIA = qn('w:eastAsia')
+
+DOCX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+
+# Cache-Control applied to the static informational endpoints
+STATIC_ENDPOINT_CACHE_CONTROL = 'public, max-age=300'
+
+# Number of rendered invoices kept in memory, keyed by a hash of the request;
+# only documents up to SPOOL_MAX_SIZE are cached
+INVOICE_CACHE_SIZE = int(os.environ.get('INVOICE_CACHE_SIZE', 32))
+
+# Rendered documents above this size are spooled to disk and streamed, not cached
+SPOOL_MAX_SIZE = 1 << 20
+
+# Seconds a single unoserver conversion may take before falling back to pandoc
+UNOSERVER_RPC_TIMEOUT = 60
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# (connect, read) timeout for image downloads, so a stalled connection can't
+# hang worker startup or a request indefinitely
+FETCH_TIMEOUT = (5, 15)
+
+# Shared HTTP session so image downloads reuse keep-alive connections
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=4))
+
+# Long-lived pool for the image downloads, sized to match the session's pool
+FETCH_EXECUTOR = ThreadPoolExecutor(max_workers=4)
+
+# === REQUEST MODELS ===
+
+class InvoiceItem(BaseModel):
+    description: str
+    unit_price: float
+    quantity: float
+    total: float
+
+class InvoiceRequest(BaseModel):
+    # Placeholder -> replacement text maps, e.g. {"{{client_name}}": "Acme"}
+    client_info: dict[str, str] = {}
+    invoice_details: dict[str, str] = {}
+    financials: dict[str, str] = {}
+    items: list[InvoiceItem] = []
+    apply_late_fee: bool = False
+    mark_as_paid: bool = False
+    # Exactly "pdf" selects PDF output; any other value produces a DOCX
+    output_format: str = Field('docx', alias='format')
+
 # === UTILITY FUNCTIONS ===
 
 def format_currency(amount):
-    if amount == 0:
+    if not amount:
         return ""
-    elif amount == int(amount):
-        return f"Rp {int(amount):,}"
-    else:
-        return f"Rp {amount:,.2f}"
+    whole = int(amount)
+    return f"Rp {whole:,}" if whole == amount else f"Rp {amount:,.2f}"
+
+def format_quantity(quantity):
+    whole = int(quantity)
+    return str(whole) if whole == quantity else str(quantity)
+
+# Parsed XML fragments are cached and deep-copied per cell; copying a small
+# lxml element is much cheaper than running the parser again. parse_xml itself
+# already reuses python-docx's single module-level parser, which has entity
+# resolution disabled.
+@functools.lru_cache(maxsize=None)
+def _border_element(border_name, color, sz):
+    return parse_xml(f'<w:{border_name} {nsdecls("w")} w:val="single" w:sz="{sz}" w:space="0" w:color="{color}"/>')
+
+@functools.lru_cache(maxsize=None)
+def _shading_element(bg_color):
+    return parse_xml(f'<w:shd {nsdecls("w")} w:fill="{bg_color}" />')
+
+_TC_BORDERS_ELM = parse_xml(f'<w:tcBorders {nsdecls("w")}></w:tcBorders>')
 
 def set_cell_border(cell, side, color="FFFFFF", sz=4):
     tc = cell._tc
@@ -39,10 +133,10 @@ def set_cell_border(cell, side, color="FFFFFF", sz=4):
     }
     border_name = side_mapping.get(side.lower())
     if border_name:
-        border = parse_xml(f'<w:{border_name} {nsdecls("w")} w:val="single" w:sz="{sz}" w:space="0" w:color="{color}"/>')
+        border = copy.deepcopy(_border_element(border_name, color, sz))
         tcBorders = tcPr.first_child_found_in("w:tcBorders")
         if tcBorders is None:
-            tcBorders = parse_xml(f'<w:tcBorders {nsdecls("w")}></w:tcBorders>')
+            tcBorders = copy.deepcopy(_TC_BORDERS_ELM)
             tcPr.append(tcBorders)
         tcBorders.append(border)
 
@@ -55,64 +149,98 @@ def set_cell_font(cell, font_name="Courier New", font_size=10):
         for run in paragraph.runs:
             run.font.name = font_name
             run.font.size = Pt(font_size)
-            run._element.rPr.rFonts.set(qn('w:eastAsia'), font_name)
+            run._element.rPr.rFonts.set(QN_EAST_ASIA, font_name)
 
 def apply_cell_style(cell, bg_color="#ddefd5"):
-    shading_elm = parse_xml(f'<w:shd {nsdecls("w")} w:fill="{bg_color}" />')
+    shading_elm = copy.deepcopy(_shading_element(bg_color))
     cell._tc.get_or_add_tcPr().append(shading_elm)
     set_white_borders(cell, sz=6)
     set_cell_font(cell)
 
+def load_template(path, font_name="Courier New"):
+    # Make the font the document default so text rewritten by python-docx
+    # (which drops run formatting) still renders in it, then serialise the
+    # patched template once for every request to parse its own copy from.
+    doc = Document(path)
+    rPr = doc.styles.element.xpath('./w:docDefaults/w:rPrDefault/w:rPr')[0]
+    rFonts = rPr.get_or_add_rFonts()
+    for attr in ('w:ascii', 'w:hAnsi', 'w:eastAsia', 'w:cs'):
+        rFonts.set(qn(attr), font_name)
+    output = io.BytesIO()
+    doc.save(output)
+    return output.getvalue()
+
 def replace_placeholders(doc, replacements):
+    if not replacements:
+        return doc
+    # One alternation over all keys, longest first so overlapping keys match greedily
+    pattern = re.compile('|'.join(re.escape(key) for key in sorted(replacements, key=len, reverse=True)))
+
+    def sub(match):
+        return replacements[match.group(0)]
+
     for paragraph in doc.paragraphs:
-        for key, value in replacements.items():
-            if key in paragraph.text:
-                paragraph.text = paragraph.text.replace(key, value)
+        text = paragraph.text
+        if pattern.search(text):
+            paragraph.text = pattern.sub(sub, text)
     for table in doc.tables:
         for row in table.rows:
             for cell in row.cells:
-                for key, value in replacements.items():
-                    if key in cell.text:
-                        cell.text = cell.text.replace(key, value)
+                text = cell.text
+                if pattern.search(text):
+                    cell.text = pattern.sub(sub, text)
     return doc
 
+def build_item_row_template(items_table):
+    # Style one empty row up front; each item row is then a cheap deepcopy of it
+    row = items_table.add_row()
+    for cell, alignment in zip(row.cells, ITEM_ALIGNMENTS):
+        cell.text = ""
+        apply_cell_style(cell)
+        for paragraph in cell.paragraphs:
+            paragraph.alignment = alignment
+    template_tr = row._tr
+    items_table._tbl.remove(template_tr)
+    return template_tr
+
 def update_items_table(doc, items):
     items_table = doc.tables[0]
-    for i in range(len(items_table.rows)):
-        for cell in items_table.rows[i].cells:
+    for row in items_table.rows:
+        for cell in row.cells:
             set_white_borders(cell, sz=6)
-    while len(items_table.rows) > 2:
-        items_table._tbl.remove(items_table.rows[2]._tr)
-    placeholder_row = items_table.rows[1]
+    tbl = items_table._tbl
+    for tr in tbl.tr_lst[2:]:
+        tbl.remove(tr)
+    placeholder_tr = tbl.tr_lst[1]
+    template_tr = build_item_row_template(items_table)
     for item in items:
-        row = items_table.add_row()
-        row.cells[0].text = item['description']
-        row.cells[1].text = format_currency(item['unit_price'])
-        quantity = item['quantity']
-        if quantity == int(quantity):
-            row.cells[2].text = str(int(quantity))
-        else:
-            row.cells[2].text = str(quantity)
-        row.cells[3].text = format_currency(item['total'])
-        for i, cell in enumerate(row.cells):
-            apply_cell_style(cell)
-            alignments = [WD_ALIGN_PARAGRAPH.LEFT, WD_ALIGN_PARAGRAPH.RIGHT, 
-                         WD_ALIGN_PARAGRAPH.CENTER, WD_ALIGN_PARAGRAPH.RIGHT]
-            for paragraph in cell.paragraphs:
-                paragraph.alignment = alignments[i]
-    items_table._tbl.remove(placeholder_row._tr)
+        texts = (
+            item.description,
+            format_currency(item.unit_price),
+            format_quantity(item.quantity),
+            format_currency(item.total),
+        )
+        tr = copy.deepcopy(template_tr)
+        for run, text in zip(tr.xpath('./w:tc/w:p/w:r'), texts):
+            run.text = text
+        tbl.append(tr)
+    tbl.remove(placeholder_tr)
     return doc
 
 def style_financial_table(doc, apply_late_fee):
     financial_table = doc.tables[1]
-    for row in financial_table.rows:
-        for cell in row.cells:
+    # Walk the <w:tr>/<w:tc> elements directly; Table.rows and Row.cells rebuild
+    # their wrapper lists on every access. The template has no merged cells.
+    tr_lst = financial_table._tbl.tr_lst
+    for tr in tr_lst:
+        cells = [_Cell(tc, financial_table) for tc in tr.tc_lst]
+        for cell in cells:
             set_white_borders(cell)
             set_cell_font(cell)
-        for paragraph in row.cells[1].paragraphs:
+        for paragraph in cells[1].paragraphs:
             paragraph.alignment = WD_ALIGN_PARAGRAPH.RIGHT
     if apply_late_fee:
-        late_fee_cell = financial_table.rows[3].cells[0]
+        late_fee_cell = _Cell(tr_lst[3].tc_lst[0], financial_table)
         if "LATE FEE" in late_fee_cell.text:
             original_text = late_fee_cell.text
             late_fee_cell.text = ""
@@ -120,121 +248,188 @@ def style_financial_table(doc, apply_late_fee):
             run = paragraph.add_run(original_text)
             run.font.color.rgb = RGBColor.from_string('d95132')
             run.font.name = "Courier New"
-            run._element.rPr.rFonts.set(qn('w:eastAsia'), "Courier New")
+            run._element.rPr.rFonts.set(QN_EAST_ASIA, "Courier New")
 
-def fetch_image(url):
+@functools.lru_cache(maxsize=8)
+def _fetch_bytes(url):
+    # Stamp and signature never change, so download each URL once per process.
+    # Failures raise and are therefore not cached; the next request retries.
     try:
         headers = {
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"
         }
-        response = requests.get(url, headers=headers, stream=True, allow_redirects=True)
+        response = SESSION.get(url, headers=headers, stream=True, allow_redirects=True, timeout=FETCH_TIMEOUT)
         if response.status_code != 200:
             raise Exception(f"Failed to fetch image. Status: {response.status_code}")
-        image_data = io.BytesIO(response.content)
-        img = Image.open(image_data)
-        img.verify()
-        image_data.seek(0)
-        return image_data
+        content = response.content
+        # A signature check is enough to reject Drive's HTML error pages;
+        # add_picture fails cleanly on anything truly corrupt
+        if not content.startswith(PNG_SIGNATURE):
+            raise Exception("Downloaded file is not a PNG image")
+        return content
     except Exception as e:
         raise Exception(f"Error fetching image: {str(e)}")
 
-def add_paid_stamp_and_signature(doc):
-    try:
-        stamp_data = fetch_image(PAID_STAMP_URL)
-        signature_data = fetch_image(SIGNATURE_URL)
+def fetch_image(url):
+    return io.BytesIO(_fetch_bytes(url))
 
-        stamp_tmp = tempfile.NamedTemporaryFile(delete=False, suffix='.png')
-        signature_tmp = tempfile.NamedTemporaryFile(delete=False, suffix='.png')
+def fetch_images(*urls):
+    # Download independent images in parallel instead of one after another
+    return list(FETCH_EXECUTOR.map(fetch_image, urls))
 
-        stamp_img = Image.open(stamp_data)
-        stamp_img.save(stamp_tmp.name, format="PNG")
-        stamp_tmp.close()
+@functools.lru_cache(maxsize=16)
+def _anchored_drawing_element(rId, size, horizontal, vertical, shape_id):
+    # Every request loads the same template, so the image relationship gets the
+    # same rId each time and the parsed drawing can be reused via deepcopy.
+    extent = Inches(size)
+    return parse_xml(f"""
+        <w:drawing xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+            xmlns:wp="http://schemas.openxmlformats.org/drawingml/2006/wordprocessingDrawing"
+            xmlns:a="http://schemas.openxmlformats.org/drawingml/2006/main"
+            xmlns:pic="http://schemas.openxmlformats.org/drawingml/2006/picture"
+            xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">
+            <wp:anchor distT="0" distB="0" distL="0" distR="0" simplePos="0" relativeHeight="{250 + shape_id}" behindDoc="0" locked="0" layoutInCell="1" allowOverlap="1">
+                <wp:simplePos x="0" y="0"/>
+                <wp:positionH relativeFrom="page">
+                    <wp:posOffset>{Inches(horizontal)}</wp:posOffset>
+                </wp:positionH>
+                <wp:positionV relativeFrom="page">
+                    <wp:posOffset>{Inches(vertical)}</wp:posOffset>
+                </wp:positionV>
+                <wp:extent cx="{extent}" cy="{extent}"/>
+                <wp:effectExtent l="0" t="0" r="0" b="0"/>
+                <wp:wrapTopAndBottom/>
+                <wp:docPr id="{shape_id}" name="Picture {shape_id}"/>
+                <wp:cNvGraphicFramePr/>
+                <a:graphic>
+                    <a:graphicData uri="http://schemas.openxmlformats.org/drawingml/2006/picture">
+                        <pic:pic>
+                            <pic:nvPicPr>
+                                <pic:cNvPr id="0" name="image.png"/>
+                                <pic:cNvPicPr/>
+                            </pic:nvPicPr>
+                            <pic:blipFill>
+                                <a:blip r:embed="{rId}"/>
+                                <a:stretch><a:fillRect/></a:stretch>
+                            </pic:blipFill>
+                            <pic:spPr>
+                                <a:xfrm>
+                                    <a:off x="0" y="0"/>
+                                    <a:ext cx="{extent}" cy="{extent}"/>
+                                </a:xfrm>
+                                <a:prstGeom prst="rect"/>
+                            </pic:spPr>
+                        </pic:pic>
+                    </a:graphicData>
+                </a:graphic>
+            </wp:anchor>
+        </w:drawing>
+    """)
 
-        signature_img = Image.open(signature_data)
-        signature_img.save(signature_tmp.name, format="PNG")
-        signature_tmp.close()
+def add_anchored_picture(doc, image_data, size, horizontal, vertical, shape_id):
+    # Relate the image part directly and emit the whole <w:drawing> in one go,
+    # rather than add_picture() followed by swapping its inline for an anchor.
+    rId, _ = doc.part.get_or_add_image(image_data)
+    paragraph = doc.add_paragraph()
+    run = paragraph.add_run()
+    run._r.append(copy.deepcopy(_anchored_drawing_element(rId, size, horizontal, vertical, shape_id)))
+
+def add_paid_stamp_and_signature(doc):
+    try:
+        stamp_data, signature_data = fetch_images(PAID_STAMP_URL, SIGNATURE_URL)
 
         # Add stamp
-        stamp_paragraph = doc.add_paragraph()
-        stamp_run = stamp_paragraph.add_run()
-        stamp_run.add_picture(stamp_tmp.name, width=Inches(2.17), height=Inches(2.17))
-        
-        stamp_run_element = stamp_run._r
-        stamp_drawing = stamp_run_element.xpath('.//w:drawing')[0]
-        graphic_elements = stamp_drawing.xpath('.//a:graphic', namespaces={'a': 'http://schemas.openxmlformats.org/drawingml/2006/main'})
-        graphic_xml = ET.tostring(graphic_elements[0], encoding='unicode').replace('\n', '')
-
-        stamp_horizontal = 5.09 * 914400
-        stamp_vertical = 6.64 * 914400
-
-        stamp_drawing.getparent().replace(stamp_drawing, parse_xml(f"""
-            <w:drawing xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"
-                xmlns:wp="http://schemas.openxmlformats.org/drawingml/2006/wordprocessingDrawing">
-                <wp:anchor distT="0" distB="0" distL="0" distR="0" simplePos="0" relativeHeight="251" behindDoc="0" locked="0" layoutInCell="1" allowOverlap="1">
-                    <wp:simplePos x="0" y="0"/>
-                    <wp:positionH relativeFrom="page">
-                        <wp:posOffset>{int(stamp_horizontal)}</wp:posOffset>
-                    </wp:positionH>
-                    <wp:positionV relativeFrom="page">
-                        <wp:posOffset>{int(stamp_vertical)}</wp:posOffset>
-                    </wp:positionV>
-                    <wp:extent cx="{int(2.17 * 914400)}" cy="{int(2.17 * 914400)}"/>
-                    <wp:effectExtent l="0" t="0" r="0" b="0"/>
-                    <wp:wrapTopAndBottom/>
-                    <wp:docPr id="1" name="Picture 1"/>
-                    <wp:cNvGraphicFramePr/>
-                    {graphic_xml}
-                </wp:anchor>
-            </w:drawing>
-        """))
+        add_anchored_picture(doc, stamp_data, size=2.17, horizontal=5.09, vertical=6.64, shape_id=1)
 
         # Add signature
-        signature_paragraph = doc.add_paragraph()
-        signature_run = signature_paragraph.add_run()
-        signature_run.add_picture(signature_tmp.name, width=Inches(1.92), height=Inches(1.92))
-
-        signature_run_element = signature_run._r
-        signature_drawing = signature_run_element.xpath('.//w:drawing')[0]
-        graphic_elements = signature_drawing.xpath('.//a:graphic', namespaces={'a': 'http://schemas.openxmlformats.org/drawingml/2006/main'})
-        graphic_xml = ET.tostring(graphic_elements[0], encoding='unicode').replace('\n', '')
-
-        signature_horizontal = 5.64 * 914400
-        signature_vertical = 8.11 * 914400
-
-        signature_drawing.getparent().replace(signature_drawing, parse_xml(f"""
-            <w:drawing xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"
-                xmlns:wp="http://schemas.openxmlformats.org/drawingml/2006/wordprocessingDrawing">
-                <wp:anchor distT="0" distB="0" distL="0" distR="0" simplePos="0" relativeHeight="252" behindDoc="0" locked="0" layoutInCell="1" allowOverlap="1">
-                    <wp:simplePos x="0" y="0"/>
-                    <wp:positionH relativeFrom="page">
-                        <wp:posOffset>{int(signature_horizontal)}</wp:posOffset>
-                    </wp:positionH>
-                    <wp:positionV relativeFrom="page">
-                        <wp:posOffset>{int(signature_vertical)}</wp:posOffset>
-                    </wp:positionV>
-                    <wp:extent cx="{int(1.92 * 914400)}" cy="{int(1.92 * 914400)}"/>
-                    <wp:effectExtent l="0" t="0" r="0" b="0"/>
-                    <wp:wrapTopAndBottom/>
-                    <wp:docPr id="2" name="Picture 2"/>
-                    <wp:cNvGraphicFramePr/>
-                    {graphic_xml}
-                </wp:anchor>
-            </w:drawing>
-        """))
-
-        os.remove(stamp_tmp.name)
-        os.remove(signature_tmp.name)
+        add_anchored_picture(doc, signature_data, size=1.92, horizontal=5.64, vertical=8.11, shape_id=2)
 
         return doc
     except Exception as e:
-        if 'stamp_tmp' in locals() and os.path.exists(stamp_tmp.name):
-            os.remove(stamp_tmp.name)
-        if 'signature_tmp' in locals() and os.path.exists(signature_tmp.name):
-            os.remove(signature_tmp.name)
         raise Exception(f"Failed to add stamp and signature: {str(e)}")
 
+class TimeoutTransport(xmlrpc.client.Transport):
+    # ServerProxy has no timeout of its own; set one on the HTTP connection
+    def __init__(self, timeout):
+        super().__init__()
+        self.timeout = timeout
+
+    def make_connection(self, host):
+        connection = super().make_connection(host)
+        connection.timeout = self.timeout
+        return connection
+
+def convert_with_pdf_server(docx_bytes):
+    # Same call unoserver's UnoClient makes, but with a socket timeout so a hung
+    # soffice falls back to pandoc instead of stalling the worker
+    with xmlrpc.client.ServerProxy(
+        f"http://127.0.0.1:{UNOSERVER_PORT}", allow_none=True,
+        transport=TimeoutTransport(UNOSERVER_RPC_TIMEOUT)
+    ) as proxy:
+        result = proxy.convert(None, docx_bytes, None, 'pdf', None, [], True)
+    return result.data
+
+def convert_to_pdf(docx_bytes):
+    # Only try unoserver when a launcher actually started it; otherwise go
+    # straight to pandoc instead of failing (and logging) on every request
+    if pdf_server_available():
+        try:
+            return convert_with_pdf_server(docx_bytes)
+        except Exception as e:
+            app.logger.warning(f"unoserver conversion failed, falling back to pandoc: {e}")
+    # Pipe the document through pandoc's stdin/stdout rather than temp files
+    result = subprocess.run(
+        [pypandoc.get_pandoc_path(), '-f', 'docx', '-t', 'pdf', '-o', '-'],
+        input=docx_bytes, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    if result.returncode != 0:
+        raise Exception(f"PDF conversion failed: {result.stderr.decode(errors='replace')}")
+    return result.stdout
+
+# Invoice template, read and patched once at startup; each request parses its own copy
+TEMPLATE_BYTES = load_template(TEMPLATE_PATH)
+
+_invoice_cache = OrderedDict()
+_invoice_cache_lock = threading.Lock()
+
+def invoice_cache_key(data):
+    canonical = json.dumps(data, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+def get_cached_invoice(key):
+    with _invoice_cache_lock:
+        entry = _invoice_cache.get(key)
+        if entry is not None:
+            _invoice_cache.move_to_end(key)
+        return entry
+
+def cache_invoice(key, entry):
+    # Like large DOCX output, large PDFs are not kept, which bounds the cache
+    # at INVOICE_CACHE_SIZE * SPOOL_MAX_SIZE bytes per worker
+    content = entry[0]
+    if len(content) > SPOOL_MAX_SIZE:
+        return
+    with _invoice_cache_lock:
+        _invoice_cache[key] = entry
+        _invoice_cache.move_to_end(key)
+        while len(_invoice_cache) > INVOICE_CACHE_SIZE:
+            _invoice_cache.popitem(last=False)
+
+# Warm the image cache so the first paid invoice doesn't pay for the downloads.
+# A failure here is not fatal: the fetch is retried on the next request.
+try:
+    fetch_images(PAID_STAMP_URL, SIGNATURE_URL)
+except Exception as e:
+    app.logger.warning(f"Could not pre-fetch stamp and signature: {e}")
+
 # === API ENDPOINTS ===
 
+@app.after_request
+def add_cache_headers(response):
+    if request.path in ('/', '/health'):
+        response.headers['Cache-Control'] = STATIC_ENDPOINT_CACHE_CONTROL
+    return response
+
 @app.route('/')
 def home():
     return jsonify({
@@ -250,22 +445,47 @@ def home():
 def health():
     return jsonify({"status": "healthy"})
 
+def invoice_response(content, mimetype, download_name):
+    if mimetype == 'application/pdf':
+        # A plain Response rather than send_file: Flask-Compress skips
+        # send_file's passthrough responses, and PDFs compress well
+        response = Response(content, mimetype=mimetype)
+        response.headers.set('Content-Disposition', 'attachment', filename=download_name)
+        return response
+    return send_file(
+        io.BytesIO(content),
+        mimetype=mimetype,
+        as_attachment=True,
+        download_name=download_name
+    )
+
 @app.route('/generate-invoice', methods=['POST'])
 def generate_invoice():
+    # Parse and validate the body in one step so malformed requests fail fast
+    try:
+        invoice = InvoiceRequest.model_validate_json(request.get_data())
+    except ValidationError as e:
+        return jsonify({"error": "Invalid invoice request", "details": json.loads(e.json(include_url=False))}), 400
+    
     try:
-        data = request.json
+        # Identical requests render identical documents, so replay them from memory
+        cache_key = invoice_cache_key(invoice.model_dump())
+        cached = get_cached_invoice(cache_key)
+        if cached is not None:
+            content, mimetype, download_name = cached
+            return invoice_response(content, mimetype, download_name)
         
         # Extract data from request
-        client_info = data.get('client_info', {})
-        invoice_details = data.get('invoice_details', {})
-        items = data.get('items', [])
-        financials = data.get('financials', {})
-        apply_late_fee = data.get('apply_late_fee', False)
-        mark_as_paid = data.get('mark_as_paid', False)
-        output_format = data.get('format', 'docx')  # 'docx' or 'pdf'
+        client_info = invoice.client_info
+        invoice_details = invoice.invoice_details
+        items = invoice.items
+        financials = invoice.financials
+        apply_late_fee = invoice.apply_late_fee
+        mark_as_paid = invoice.mark_as_paid
+        output_format = invoice.output_format
         
         # Load template
-        doc = Document('Invoice_Template_MarketixLab.docx')
+        doc = Document(io.BytesIO(TEMPLATE_BYTES))
         
         # Prepare replacements
         replacements = {**client_info, **invoice_details, **financials}
@@ -284,50 +504,47 @@ def generate_invoice():
         if mark_as_paid:
             doc = add_paid_stamp_and_signature(doc)
         
-        # Set font for all paragraphs
-        for paragraph in doc.paragraphs:
-            for run in paragraph.runs:
-                run.font.name = "Courier New"
-                run._element.rPr.rFonts.set(qn('w:eastAsia'), "Courier New")
-        
-        # Generate output based on format
-        if output_format == 'pdf':
-            # Save as temporary DOCX first
-            temp_docx = tempfile.NamedTemporaryFile(delete=False, suffix='.docx')
-            doc.save(temp_docx.name)
-            temp_docx.close()
-            
-            # Convert to PDF
-            temp_pdf = tempfile.NamedTemporaryFile(delete=False, suffix='.pdf')
-            temp_pdf.close()
-            pypandoc.convert_file(temp_docx.name, 'pdf', outputfile=temp_pdf.name)
-            
-            # Clean up DOCX
-            os.remove(temp_docx.name)
-            
-            # Return PDF
-            return send_file(
-                temp_pdf.name,
-                mimetype='application/pdf',
-                as_attachment=True,
-                download_name=f"Invoice_{invoice_details.get('{{invoice_number}}', 'unknown')}.pdf"
-            )
-        else:
-            # Return DOCX
-            docx_output = io.BytesIO()
+        # Generate output based on format. Small documents stay in memory;
+        # larger ones spill to disk instead of being held in a BytesIO.
+        docx_output = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+        streaming = False
+        try:
             doc.save(docx_output)
+            docx_size = docx_output.tell()
             docx_output.seek(0)
-            
-            return send_file(
-                docx_output,
-                mimetype='application/vnd.openxmlformats-officedocument.wordprocessingml.document',
-                as_attachment=True,
-                download_name=f"Invoice_{invoice_details.get('{{invoice_number}}', 'unknown')}.docx"
-            )
+            download_name = f"Invoice_{invoice_details.get('{{invoice_number}}', 'unknown')}"
+            if output_format == 'pdf':
+                # Convert the DOCX to PDF
+                content = convert_to_pdf(docx_output.read())
+                mimetype = 'application/pdf'
+                download_name += '.pdf'
+            elif docx_size > SPOOL_MAX_SIZE:
+                # Too large to cache: stream it from the spooled file, which
+                # is then closed (and deleted) once the response is done
+                response = send_file(
+                    docx_output,
+                    mimetype=DOCX_MIMETYPE,
+                    as_attachment=True,
+                    download_name=download_name + '.docx'
+                )
+                response.call_on_close(docx_output.close)
+                streaming = True
+                return response
+            else:
+                content = docx_output.read()
+                mimetype = DOCX_MIMETYPE
+                download_name += '.docx'
+        finally:
+            if not streaming:
+                docx_output.close()
+        cache_invoice(cache_key, (content, mimetype, download_name))
+        
+        return invoice_response(content, mimetype, download_name)
             
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 10000))
+    start_pdf_server()
     app.run(host='0.0.0.0', port=port, debug=False)
\ No newline at end of file
@@ -0,0 +1,26 @@
+import multiprocessing
+import os
+
+from pdf_server import start_pdf_server
+
+# Picked up automatically by `gunicorn api:app` from the working directory
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 10000)}"
+
+# Async workers let one process keep serving while another request waits on
+# image downloads or PDF conversion; keep-alive lets clients reuse connections.
+worker_class = "gevent"
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+worker_connections = 200
+keepalive = 30
+
+# PDF conversion can take several seconds
+timeout = 120
+
+def on_starting(server):
+    # Start a single unoserver in the master, shared by all workers
+    server.unoserver = start_pdf_server()
+
+def on_exit(server):
+    if server.unoserver is not None:
+        server.unoserver.terminate()
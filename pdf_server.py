@@ -0,0 +1,47 @@
+import atexit
+import os
+import shutil
+import socket
+import subprocess
+import time
+
+# Launching the shared LibreOffice (unoserver) instance used for PDF output.
+# Kept free of heavy imports so gunicorn's master can use it without loading
+# requests/ssl before gevent monkey-patches the workers.
+#
+# unoserver has to be installed into LibreOffice's own Python (it needs the
+# `uno` module), not into the app's environment, for the launcher to work.
+
+UNOSERVER_PORT = int(os.environ.get('UNOSERVER_PORT', 2003))
+
+# How long to wait for LibreOffice to start and the RPC port to open
+UNOSERVER_START_TIMEOUT = 60
+
+def _port_open(port):
+    try:
+        with socket.create_connection(('127.0.0.1', port), timeout=1):
+            return True
+    except OSError:
+        return False
+
+def start_pdf_server():
+    # Keep one LibreOffice instance warm so PDF requests don't each pay for a
+    # converter cold start. Without LibreOffice we fall back to pandoc.
+    if shutil.which('soffice') is None or shutil.which('unoserver') is None:
+        return None
+    process = subprocess.Popen(['unoserver', '--port', str(UNOSERVER_PORT)])
+    # Only report the server as available once it is actually accepting
+    # connections, so requests never race LibreOffice's startup
+    deadline = time.monotonic() + UNOSERVER_START_TIMEOUT
+    while not _port_open(UNOSERVER_PORT):
+        if process.poll() is not None or time.monotonic() > deadline:
+            process.terminate()
+            return None
+        time.sleep(0.5)
+    atexit.register(process.terminate)
+    # Inherited by gunicorn workers, which fork after the launcher runs
+    os.environ['UNOSERVER_AVAILABLE'] = '1'
+    return process
+
+def pdf_server_available():
+    return os.environ.get('UNOSERVER_AVAILABLE') == '1'